@@ -1,128 +1,397 @@
 # ============================================================
 # FINAL MASTER VERSION — OPTION A
 # Anonymous Chat + Media Forwarder Bot (Full Working Code)
-# python-telegram-bot v20.3
+# python-telegram-bot v20.8
 # Single Cell — No Patching Needed
 # ============================================================
 
-import nest_asyncio
-nest_asyncio.apply()
-
 import os
+
+# Colab/Jupyter already run an event loop: set USE_NEST_ASYNCIO=1 there.
+# Production (python3 bot.py) owns its loop and skips the patch.
+if os.getenv("USE_NEST_ASYNCIO") == "1":
+    import nest_asyncio
+    nest_asyncio.apply()
+
 import json
 import time
+import asyncio
 import logging
+import sqlite3
 
-from typing import Dict, List
+from collections import OrderedDict, deque
+from typing import Deque, Dict, FrozenSet, List, Optional, Set, Tuple
 
 from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
+from telegram.request import HTTPXRequest
+
+logging.getLogger("telegram").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
 
 # ============================================================
 # CONFIG — FALLBACK VALUES YOU GAVE
 # ============================================================
+def _parse_admins(raw):
+    ids = []
+    for part in raw.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            ids.append(int(part))
+        except ValueError:
+            log.warning("Ignoring invalid ADMIN_IDS entry %r", part)
+    if not ids:
+        log.warning("No valid ADMIN_IDS: admin alerts and admin commands are disabled")
+    return ids
+
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "BOT_TOKEN"
 GROUP_ID = int(os.getenv("GROUP_ID") or "GROUP_ID")
-ADMIN_IDS = [int(x) for x in (os.getenv("ADMIN_IDS") or "admi_id").split(",")]
-
-STATE_FILE = "anon_state.json"
+ADMIN_IDS: FrozenSet[int] = frozenset(_parse_admins(os.getenv("ADMIN_IDS") or "admi_id"))
+
+CONCURRENT_UPDATES = 256
+CONNECTION_POOL_SIZE = 64
+
+STATE_FILE = "anon_state.db"
+# Pre-SQLite state, imported once into an empty database
+LEGACY_STATE_FILE = "anon_state.json"
+STATE_FLUSH_DELAY = 0.25
+STATE_SHUTDOWN_TIMEOUT = 5
+STATE_WRITE_RETRIES = 5
+STATE_RETRY_MAX_DELAY = 30
 RATE_LIMIT = 1.3
-
-logging.getLogger("telegram").setLevel(logging.WARNING)
+RATE_BURST = 3
+RATE_MAX_USERS = 50000
+
+# Relays to a partner are buffered briefly and sent with one copy_messages
+# call. Long texts usually arrive split into several messages, so wait longer.
+RELAY_DELAY = 0.3
+RELAY_LONG_DELAY = 1.5
+RELAY_LONG_TEXT = 4000
+RELAY_BATCH_MAX = 100
+
+# Retries after a 429 before AIORateLimiter gives up on a call
+RATE_LIMIT_RETRIES = 3
+
+ADMIN_FLUSH_DELAY = 5
+MESSAGE_MAX_LEN = 4096
+
+FORWARD_QUEUE_SIZE = 1000
+FORWARD_SHUTDOWN_TIMEOUT = 10
+# Media kinds archived to GROUP_ID, most frequent first
+FORWARD_ATTRS = ("photo", "document", "video", "sticker", "voice", "audio")
+
+MENU_TXT = (
+    "Anonymous Bot Activated\n"
+    "/anon_start – Find partner\n"
+    "/anon_next – Next partner\n"
+    "/anon_stop – Stop chat\n"
+    "/status – Chat status"
+)
 
 # ============================================================
 # STATE
 # ============================================================
-queue: List[int] = []
+# FIFO order lives in the deque, membership in the set. Removal only
+# touches the set; stale deque entries are skipped when popped.
+queue: Deque[int] = deque()
+queue_set: Set[int] = set()
 sessions: Dict[int, int] = {}
-last_time: Dict[int, float] = {}
+# uid -> (tokens, last refill), least recently active first
+last_time: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+
+# (from_chat, partner) -> buffered message ids / first buffered at / flush deadline
+relay_buf: Dict[Tuple[int, int], List[int]] = {}
+relay_start: Dict[Tuple[int, int], float] = {}
+relay_due: Dict[Tuple[int, int], float] = {}
+
+# (chat_id, message_id) waiting to be forwarded to GROUP_ID
+forward_q: "asyncio.Queue[Tuple[int, int]]" = asyncio.Queue(maxsize=FORWARD_QUEUE_SIZE)
+_forward_task: Optional[asyncio.Task] = None
+
+db: Optional[sqlite3.Connection] = None
+_pending_ops: List[Tuple[str, tuple]] = []
+_flush_task: Optional[asyncio.Task] = None
+# Set when queued statements were dropped; the next flush rewrites both tables
+_resync_needed = False
+
+# (format, args) pairs, formatted once when the digest is built
+admin_buf: Deque[Tuple[str, tuple]] = deque()
+_admin_task: Optional[asyncio.Task] = None
 
 # ============================================================
 # PERSISTENCE
 # ============================================================
-def save_state():
+def open_db():
+    conn = sqlite3.connect(STATE_FILE, check_same_thread=False)
     try:
-        with open(STATE_FILE, "w") as f:
-            json.dump({"queue": queue, "sessions": sessions}, f)
-    except:
-        pass
+        conn.execute("PRAGMA journal_mode=WAL")
+        # One row per pair, keyed by the smaller uid
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "uid INTEGER PRIMARY KEY, partner INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue ("
+            "pos INTEGER PRIMARY KEY AUTOINCREMENT, uid INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS queue_uid ON queue (uid)")
+        conn.commit()
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+def read_state(conn):
+    q = deque(uid for (uid,) in conn.execute("SELECT uid FROM queue ORDER BY pos"))
+    s = {}
+    for a, b in conn.execute("SELECT uid, partner FROM sessions"):
+        s[a] = b
+        s[b] = a
+    return q, s
+
+def import_legacy_state(conn):
+    with open(LEGACY_STATE_FILE, "r") as f:
+        data = json.load(f)
+    uids = dict.fromkeys(int(u) for u in data.get("queue", []))
+    pairs = {}
+    for k, v in data.get("sessions", {}).items():
+        a, b = int(k), int(v)
+        pairs[min(a, b)] = max(a, b)
+    with conn:
+        conn.executemany("INSERT INTO queue (uid) VALUES (?)", [(u,) for u in uids])
+        conn.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?)", pairs.items())
+    os.replace(LEGACY_STATE_FILE, LEGACY_STATE_FILE + ".imported")
+    log.warning("Imported %d queued users and %d pairs from %s",
+                len(uids), len(pairs), LEGACY_STATE_FILE)
+
+def _move_aside(path):
+    # Keep the broken file (and its WAL) around for inspection
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.replace(path + suffix, path + ".corrupt" + suffix)
+
+def _write_state_sync(ops):
+    # One transaction per flush, statements applied in mutation order
+    with db:
+        for sql, params in ops:
+            db.execute(sql, params)
+
+def _snapshot_ops():
+    # Rewrite both tables from memory; supersedes any queued statements
+    ops = [("DELETE FROM queue", ()), ("DELETE FROM sessions", ())]
+    for uid in dict.fromkeys(u for u in queue if u in queue_set):
+        ops.append(("INSERT INTO queue (uid) VALUES (?)", (uid,)))
+    for a, b in sessions.items():
+        if a < b:
+            ops.append(("INSERT INTO sessions VALUES (?, ?)", (a, b)))
+    return ops
+
+async def _flush_after(delay):
+    # Coalesce every mutation made during the window into one write
+    global _pending_ops, _flush_task, _resync_needed
+    failures = 0
+    try:
+        while _pending_ops or _resync_needed:
+            # Back off exponentially while writes keep failing
+            await asyncio.sleep(min(delay * 2 ** failures, STATE_RETRY_MAX_DELAY))
+            resync = _resync_needed
+            ops = _snapshot_ops() if resync else _pending_ops
+            _pending_ops = []
+            try:
+                await asyncio.to_thread(_write_state_sync, ops)
+                failures = 0
+                if resync:
+                    _resync_needed = False
+            except Exception:
+                failures += 1
+                log.exception("State write failed (attempt %d/%d)", failures, STATE_WRITE_RETRIES)
+                if failures >= STATE_WRITE_RETRIES:
+                    # Stop retrying; the next mutation starts a full rewrite
+                    _resync_needed = True
+                    _pending_ops = []
+                    notify_admins(
+                        app, "State writes failed %d times; saved state will be rewritten on the next write",
+                        failures,
+                    )
+                    return
+                # The transaction rolled back; keep the ops for the next try
+                if not resync:
+                    _pending_ops = ops + _pending_ops
+    finally:
+        _flush_task = None
+
+def save_state(sql, params=()):
+    global _flush_task
+    _pending_ops.append((sql, params))
+    if _flush_task is None:
+        _flush_task = asyncio.get_event_loop().create_task(_flush_after(STATE_FLUSH_DELAY))
 
 def load_state():
-    global queue, sessions
+    global db, queue, queue_set, sessions
     try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, "r") as f:
-                data = json.load(f)
-            queue = data.get("queue", [])
-            sessions = {int(k): int(v) for k, v in data.get("sessions", {}).items()}
-    except:
-        queue = []
-        sessions = {}
+        db = open_db()
+        queue, sessions = read_state(db)
+        if not queue and not sessions and os.path.exists(LEGACY_STATE_FILE):
+            try:
+                import_legacy_state(db)
+            except Exception:
+                log.exception("Could not import %s", LEGACY_STATE_FILE)
+            queue, sessions = read_state(db)
+    except sqlite3.DatabaseError:
+        log.exception("State database %s is unreadable, starting empty", STATE_FILE)
+        if db is not None:
+            db.close()
+        _move_aside(STATE_FILE)
+        db = open_db()
+        queue, sessions = deque(), {}
+    queue_set = set(queue)
 
 # ============================================================
 # HELPERS
 # ============================================================
 def is_admin(uid): return uid in ADMIN_IDS
 
-async def notify_admins(app, text):
-    for adm in ADMIN_IDS:
-        try:
-            await app.bot.send_message(adm, f"[ADMIN]\n{text}")
-        except:
-            pass
+def notify_admins(app, fmt, *args):
+    global _admin_task
+    log.error(fmt, *args)
+    admin_buf.append((fmt, args))
+    if _admin_task is None:
+        _admin_task = asyncio.get_event_loop().create_task(flush_admins(app))
+
+async def flush_admins(app):
+    # Failures tend to come in storms; send them as a few digests
+    global _admin_task
+    await asyncio.sleep(ADMIN_FLUSH_DELAY)
+    _admin_task = None
+
+    header = "[ADMIN]"
+    chunks = []
+    cur = header
+    while admin_buf:
+        fmt, args = admin_buf.popleft()
+        line = (fmt % args if args else fmt)[:MESSAGE_MAX_LEN - len(header) - 1]
+        if len(cur) + 1 + len(line) > MESSAGE_MAX_LEN:
+            chunks.append(cur)
+            cur = header
+        cur += "\n" + line
+    chunks.append(cur)
+
+    for text in chunks:
+        await asyncio.gather(
+            *(app.bot.send_message(adm, text) for adm in ADMIN_IDS),
+            return_exceptions=True,
+        )
 
 def rate_limited(uid):
-    now = time.time()
-    if uid in last_time and now - last_time[uid] < RATE_LIMIT:
+    # Token bucket: bursts of RATE_BURST, refilled at one per RATE_LIMIT seconds
+    now = time.monotonic()
+    tokens, t0 = last_time.get(uid, (RATE_BURST, now))
+    tokens = min(RATE_BURST, tokens + (now - t0) / RATE_LIMIT)
+    if tokens < 1:
         return True
-    last_time[uid] = now
+    last_time[uid] = (tokens - 1, now)
+    last_time.move_to_end(uid)
+    if len(last_time) > RATE_MAX_USERS:
+        last_time.popitem(last=False)
     return False
 
 def pair(a,b):
     sessions[a] = b
     sessions[b] = a
-    save_state()
+    save_state("INSERT OR REPLACE INTO sessions VALUES (?, ?)", (min(a, b), max(a, b)))
 
 def unpair(uid):
     p = sessions.pop(uid, None)
     if p:
         sessions.pop(p, None)
-    save_state()
+        save_state("DELETE FROM sessions WHERE uid IN (?, ?)", (uid, p))
     return p
 
+def leave_queue(uid):
+    try:
+        queue_set.remove(uid)
+    except KeyError:
+        return False
+    save_state("DELETE FROM queue WHERE uid = ?", (uid,))
+    return True
+
 def find_partner(uid):
     if uid in sessions:
         return sessions[uid]
-    if uid in queue:
-        try: queue.remove(uid)
-        except: pass
-    if queue:
-        other = queue.pop(0)
-        pair(uid, other)
-        return other
+    leave_queue(uid)
+    while queue:
+        other = queue.popleft()
+        if leave_queue(other):
+            pair(uid, other)
+            return other
     queue.append(uid)
-    save_state()
+    queue_set.add(uid)
+    save_state("INSERT INTO queue (uid) VALUES (?)", (uid,))
     return None
 
 async def send_menu(ctx, chat_id):
     try:
-        await ctx.bot.send_message(
-            chat_id,
-            "Anonymous Bot Activated\n"
-            "/anon_start – Find partner\n"
-            "/anon_next – Next partner\n"
-            "/anon_stop – Stop chat\n"
-            "/status – Chat status"
-        )
-    except:
+        await ctx.bot.send_message(chat_id, MENU_TXT)
+    except Exception:
         pass
 
+def queue_relay(ctx, partner, msg):
+    # The window is fixed from the first buffered message: RELAY_DELAY, or
+    # RELAY_LONG_DELAY once a long chunk shows up. Later messages never slide it.
+    key = (msg.chat_id, partner)
+    is_long = len(msg.text or "") >= RELAY_LONG_TEXT
+    ids = relay_buf.get(key)
+    if ids is None:
+        now = time.monotonic()
+        relay_buf[key] = [msg.message_id]
+        relay_start[key] = now
+        relay_due[key] = now + (RELAY_LONG_DELAY if is_long else RELAY_DELAY)
+        ctx.application.create_task(flush_relay(ctx, key))
+    else:
+        ids.append(msg.message_id)
+        if is_long:
+            relay_due[key] = relay_start[key] + RELAY_LONG_DELAY
+
+async def flush_relay(ctx, key):
+    while True:
+        wait = relay_due[key] - time.monotonic()
+        if wait <= 0:
+            break
+        await asyncio.sleep(wait)
+    ids = sorted(relay_buf.pop(key))
+    del relay_start[key]
+    del relay_due[key]
+
+    # The recipient was fixed when each message was queued, so deliver even
+    # if the pair split up while the batch waited (e.g. "bye" then /anon_next)
+    chat_id, partner = key
+    for i in range(0, len(ids), RELAY_BATCH_MAX):
+        try:
+            # Use copy_messages instead of forward to preserve anonymity
+            await ctx.bot.copy_messages(partner, chat_id, ids[i:i + RELAY_BATCH_MAX])
+        except Exception as e:
+            notify_admins(ctx.application, "Relay fail: %s", e)
+
+async def gather_sends(*coros):
+    # Fan out across chats; one failed chat must not stop the others
+    for res in await asyncio.gather(*coros, return_exceptions=True):
+        if isinstance(res, Exception):
+            log.warning("Send failed: %r", res)
+
+async def send_with_menu(ctx, chat_id, text):
+    # Keep text -> menu order within a chat; callers gather across chats
+    await ctx.bot.send_message(chat_id, text)
+    await send_menu(ctx, chat_id)
+
 # ============================================================
 # COMMANDS
 # ============================================================
@@ -138,18 +407,19 @@ async def show_config(update, ctx):
     await update.message.reply_text(str({
         "BOT_TOKEN": "***",
         "GROUP_ID": GROUP_ID,
-        "ADMIN_IDS": ADMIN_IDS
+        "ADMIN_IDS": sorted(ADMIN_IDS)
     }))
 
 async def clear_state(update, ctx):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Unauthorized.")
 
-    global queue, sessions
-    queue = []
+    global queue, queue_set, sessions
+    queue = deque()
+    queue_set = set()
     sessions = {}
-    if os.path.exists(STATE_FILE):
-        os.remove(STATE_FILE)
+    save_state("DELETE FROM queue")
+    save_state("DELETE FROM sessions")
 
     await update.message.reply_text("State cleared.")
     await send_menu(ctx, update.effective_user.id)
@@ -162,53 +432,44 @@ async def anon_start(update, ctx):
     p = find_partner(uid)
 
     if p:
-        await ctx.bot.send_message(uid, "🎯 Partner connected.")
-        await ctx.bot.send_message(p, "🎯 Partner connected.")
-        await send_menu(ctx, uid)
-        await send_menu(ctx, p)
+        await gather_sends(
+            send_with_menu(ctx, uid, "🎯 Partner connected."),
+            send_with_menu(ctx, p, "🎯 Partner connected."),
+        )
     else:
-        await ctx.bot.send_message(uid, "⌛ Searching for partner...")
-        await send_menu(ctx, uid)
+        await send_with_menu(ctx, uid, "⌛ Searching for partner...")
 
 async def anon_next(update, ctx):
     uid = update.effective_user.id
     old = unpair(uid)
-
-    if old:
-        await ctx.bot.send_message(old, "⚠ Partner disconnected.")
-        await send_menu(ctx, old)
-
     p = find_partner(uid)
 
+    coros = []
+    if old:
+        coros.append(send_with_menu(ctx, old, "⚠ Partner disconnected."))
     if p:
-        await ctx.bot.send_message(uid, "🎯 New partner connected.")
-        await ctx.bot.send_message(p, "🎯 New partner connected.")
-        await send_menu(ctx, uid)
-        await send_menu(ctx, p)
+        coros.append(send_with_menu(ctx, uid, "🎯 New partner connected."))
+        coros.append(send_with_menu(ctx, p, "🎯 New partner connected."))
     else:
-        await ctx.bot.send_message(uid, "⌛ Searching for partner...")
-        await send_menu(ctx, uid)
+        coros.append(send_with_menu(ctx, uid, "⌛ Searching for partner..."))
+    await gather_sends(*coros)
 
 async def anon_stop(update, ctx):
     uid = update.effective_user.id
     p = unpair(uid)
 
-    if p:
-        await ctx.bot.send_message(p, "⚠ Partner disconnected.")
-        await send_menu(ctx, p)
-
-    if uid in queue:
-        queue.remove(uid)
-        save_state()
+    leave_queue(uid)
 
-    await ctx.bot.send_message(uid, "❌ You left the chat.")
-    await send_menu(ctx, uid)
+    coros = [send_with_menu(ctx, uid, "❌ You left the chat.")]
+    if p:
+        coros.append(send_with_menu(ctx, p, "⚠ Partner disconnected."))
+    await gather_sends(*coros)
 
 async def status(update, ctx):
     uid = update.effective_user.id
     if uid in sessions:
         await update.message.reply_text("✔ Connected")
-    elif uid in queue:
+    elif uid in queue_set:
         await update.message.reply_text("⌛ Waiting")
     else:
         await update.message.reply_text("❌ Not in chat")
@@ -230,37 +491,90 @@ async def handle_all_messages(update, ctx):
         return
     
     # 1. ALWAYS forward media to group (if it has attachments)
-    if msg.photo or msg.video or msg.audio or msg.voice or msg.document or msg.sticker:
+    # Text and media never share a message, so text skips the attribute scan
+    if msg.text is None and any(getattr(msg, a) for a in FORWARD_ATTRS):
         try:
-            await ctx.bot.forward_message(GROUP_ID, msg.chat_id, msg.message_id)
-        except Exception as e:
-            await notify_admins(ctx.application, f"Group forward failed: {e}")
+            forward_q.put_nowait((msg.chat_id, msg.message_id))
+        except asyncio.QueueFull:
+            notify_admins(ctx.application, "Group forward queue full, media dropped")
     
-    # 2. Relay to partner if user is in a session
-    if uid in sessions and not rate_limited(uid):
-        partner = sessions.get(uid)
-        if partner:
-            try:
-                # Use copy_message instead of forward to preserve anonymity
-                await ctx.bot.copy_message(
-                    partner, 
-                    msg.chat_id, 
-                    msg.message_id,
-                    caption=msg.caption if msg.caption else None
-                )
-            except Exception as e:
-                await notify_admins(ctx.application, f"Relay fail: {e}")
-    
-    # 3. If not in session and not a command, show help
-    elif uid not in sessions:
+    partner = sessions.get(uid)
+
+    # 2. If not in session and not a command, show help
+    if partner is None:
         await ctx.bot.send_message(uid, "❌ Not connected to partner. Use /anon_start")
         await send_menu(ctx, uid)
 
+    # 3. Relay to partner if user is in a session
+    elif not rate_limited(uid):
+        queue_relay(ctx, partner, msg)
+
+async def forward_worker(app):
+    # Archive forwards run here so a slow group never delays partner relays
+    while True:
+        chat_id, message_id = await forward_q.get()
+        try:
+            await app.bot.forward_message(GROUP_ID, chat_id, message_id)
+        except Exception as e:
+            notify_admins(app, "Group forward failed: %s", e)
+        finally:
+            forward_q.task_done()
+
 # ============================================================
 # BUILD BOT (GLOBAL APP — REQUIRED)
 # ============================================================
-load_state()
-app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def post_init(app):
+    global _forward_task
+    # Runs before polling starts, so no update sees half-loaded state
+    await asyncio.to_thread(load_state)
+    _forward_task = asyncio.create_task(forward_worker(app))
+
+async def post_stop(app):
+    # The bot client is still open here (closed before post_shutdown), so
+    # give queued archive forwards a bounded chance to go out
+    if _forward_task is None:
+        return
+    try:
+        await asyncio.wait_for(forward_q.join(), timeout=FORWARD_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("Forward queue unfinished at shutdown; %d group forwards dropped", forward_q.qsize())
+    _forward_task.cancel()
+
+async def post_shutdown(app):
+    global _flush_task
+    # Let the pending flush land before the process exits
+    if _resync_needed and _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_after(0))
+    if _flush_task is not None:
+        done, _ = await asyncio.wait([_flush_task], timeout=STATE_SHUTDOWN_TIMEOUT)
+        if not done:
+            log.warning("State flush unfinished at shutdown; %d updates not saved", len(_pending_ops))
+            _flush_task.cancel()
+            # A write may still be running on db in its thread; leave it open
+            return
+    if db is not None:
+        db.close()
+
+app = (
+    ApplicationBuilder()
+    .token(BOT_TOKEN)
+    # State changes never await mid-update, so handlers can overlap safely
+    .concurrent_updates(CONCURRENT_UPDATES)
+    # Paces every bot call to 30/s overall and 20/min per group, retrying 429s
+    .rate_limiter(AIORateLimiter(max_retries=RATE_LIMIT_RETRIES))
+    # Outgoing calls share one pooled HTTP/2 client; polling keeps its own
+    .request(HTTPXRequest(
+        connection_pool_size=CONNECTION_POOL_SIZE,
+        read_timeout=20,
+        write_timeout=20,
+        http_version="2",
+    ))
+    .get_updates_request(HTTPXRequest(connection_pool_size=8))
+    .post_init(post_init)
+    .post_stop(post_stop)
+    .post_shutdown(post_shutdown)
+    .build()
+)
 
 # Command handlers
 app.add_handler(CommandHandler("start", start))